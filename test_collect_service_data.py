@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+import pytest
+
+agent_module = pytest.importorskip("test_simple_agent")
+ClientData = agent_module.ClientData
+ShuraLegalAgent = agent_module.ShuraLegalAgent
+
+
+def make_ctx() -> SimpleNamespace:
+    return SimpleNamespace(userdata=ClientData(), disallow_interruptions=lambda: None)
+
+
+@pytest.mark.asyncio
+async def test_whitespace_name_does_not_clear_collected_name():
+    agent = ShuraLegalAgent(timezone="Asia/Riyadh")
+    ctx = make_ctx()
+
+    await agent.collect_service_data(ctx, full_name="سارة أحمد علي", phone_number="0501234567")
+    reply = await agent.collect_service_data(ctx, full_name=" ")
+    assert ctx.userdata.full_name == "سارة أحمد علي"
+    assert reply == "ممكن أعرف نوع القضية؟"
+
+    reply = await agent.collect_service_data(
+        ctx,
+        service_type="قضية عمالية",
+        case_details="فصل تعسفي",
+        urgency="مستعجل",
+        location="الرياض",
+    )
+    assert ctx.userdata.data_collected
+    assert ctx.userdata.full_name == "سارة أحمد علي"
+    assert reply == agent_module._SAVE_SUCCESS
+
+
+@pytest.mark.asyncio
+async def test_whitespace_values_are_asked_for_again():
+    agent = ShuraLegalAgent(timezone="Asia/Riyadh")
+    ctx = make_ctx()
+
+    reply = await agent.collect_service_data(ctx, full_name="  ", phone_number="0501234567")
+    assert ctx.userdata.full_name == ""
+    assert reply == "ممكن تزوّدني باسمك الثلاثي؟"
+
+
+@pytest.mark.asyncio
+async def test_whitespace_inputs_in_other_tools_keep_collected_fields():
+    agent = ShuraLegalAgent(timezone="Asia/Riyadh")
+    ctx = make_ctx()
+
+    reply = await agent.collect_customer_name(ctx, full_name=" ")
+    assert not ctx.userdata.name_collected
+    assert reply == "ممكن أعرف اسمك الكريم؟"
+
+    await agent.collect_service_data(ctx, full_name="سارة أحمد علي", phone_number="0501234567")
+    await agent.handle_critical_cases_only(ctx, user_request="عندي شكوى", phone_number=" ")
+    assert ctx.userdata.phone_number == "0501234567"
+
+    reply = await agent.collect_service_data(ctx)
+    assert reply == "ممكن أعرف نوع القضية؟"
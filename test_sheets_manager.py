@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import re
+from types import SimpleNamespace
+
+import pytest
+
+agent_module = pytest.importorskip("test_simple_agent")
+ClientData = agent_module.ClientData
+GoogleSheetsManager = agent_module.GoogleSheetsManager
+
+
+class FakeAPIError(Exception):
+    def __init__(self, status_code: int, applied: bool = False):
+        super().__init__(f"HTTP {status_code}")
+        self.response = SimpleNamespace(status_code=status_code)
+        self.applied = applied
+
+
+class FakeWorksheet:
+    """In-memory worksheet; queued failures are raised by the next append_rows calls."""
+
+    def __init__(self, failures=()):
+        self.rows = [list(GoogleSheetsManager.HEADERS)]
+        self.append_calls = []
+        self.failures = list(failures)
+        self.read_backs = 0
+
+    def append_rows(self, rows):
+        self.append_calls.append([list(r) for r in rows])
+        failure = self.failures.pop(0) if self.failures else None
+        if failure is not None:
+            if getattr(failure, "applied", False):
+                self.rows.extend(rows)
+            raise failure
+        self.rows.extend(rows)
+
+    def col_values(self, col):
+        return [row[col - 1] for row in self.rows]
+
+    def get(self, range_name):
+        self.read_backs += 1
+        first, last = map(int, re.fullmatch(r"A(\d+):I(\d+)", range_name).groups())
+        return self.rows[first - 1:last]
+
+
+def make_manager(worksheet: FakeWorksheet) -> GoogleSheetsManager:
+    manager = GoogleSheetsManager.__new__(GoogleSheetsManager)
+    manager.worksheet = worksheet
+    manager._init_flush_state()
+    manager.DRAIN_RETRY_DELAY = 0
+    return manager
+
+
+def lead(name: str) -> ClientData:
+    return ClientData(full_name=name, phone_number="0501234567", service_type="قضية")
+
+
+def names(rows):
+    return [row[1] for row in rows]
+
+
+@pytest.mark.asyncio
+async def test_flush_writes_each_batch_with_one_append():
+    worksheet = FakeWorksheet()
+    manager = make_manager(worksheet)
+    for name in ("a", "b", "c"):
+        manager.add_client_record(lead(name))
+
+    assert await manager.flush()
+    assert [names(call) for call in worksheet.append_calls] == [["a", "b", "c"]]
+    assert await manager.flush()
+    assert len(worksheet.append_calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_transient_failure_is_retried_before_newer_rows():
+    worksheet = FakeWorksheet([FakeAPIError(429)])
+    manager = make_manager(worksheet)
+    manager.add_client_record(lead("a"))
+
+    assert not await manager.flush()
+    manager.add_client_record(lead("b"))
+    assert await manager.flush()
+
+    assert [names(call) for call in worksheet.append_calls] == [["a"], ["a"], ["b"]]
+    assert names(worksheet.rows[1:]) == ["a", "b"]
+    # A 429 means the append was rejected, so no read-back is needed
+    assert worksheet.read_backs == 0
+
+
+@pytest.mark.asyncio
+async def test_permanent_error_drops_batch_and_next_batch_is_written(caplog):
+    worksheet = FakeWorksheet([FakeAPIError(403)])
+    manager = make_manager(worksheet)
+    manager.add_client_record(lead("a"))
+
+    with caplog.at_level(logging.ERROR):
+        assert not await manager.flush()
+    assert "Dropping 1 rows" in caplog.text
+
+    manager.add_client_record(lead("b"))
+    assert await manager.flush()
+    assert names(worksheet.rows[1:]) == ["b"]
+
+
+@pytest.mark.asyncio
+async def test_transient_failures_give_up_after_max_attempts():
+    worksheet = FakeWorksheet([FakeAPIError(503)] * GoogleSheetsManager.MAX_FLUSH_ATTEMPTS)
+    manager = make_manager(worksheet)
+    manager.add_client_record(lead("a"))
+
+    for _ in range(GoogleSheetsManager.MAX_FLUSH_ATTEMPTS):
+        assert not await manager.flush()
+    assert len(worksheet.append_calls) == GoogleSheetsManager.MAX_FLUSH_ATTEMPTS
+    assert await manager.flush()
+    assert names(worksheet.rows[1:]) == []
+
+
+@pytest.mark.asyncio
+async def test_5xx_retry_skips_rows_already_in_sheet():
+    worksheet = FakeWorksheet([FakeAPIError(500, applied=True)])
+    manager = make_manager(worksheet)
+    manager.add_client_record(lead("a"))
+    manager.add_client_record(lead("b"))
+
+    assert not await manager.flush()
+    assert await manager.flush()
+
+    assert worksheet.read_backs == 1
+    assert len(worksheet.append_calls) == 1
+    assert names(worksheet.rows[1:]) == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_flusher_writes_early_once_batch_is_full():
+    worksheet = FakeWorksheet()
+    manager = make_manager(worksheet)
+    manager.FLUSH_INTERVAL = 60
+    manager.start_flusher()
+    try:
+        for i in range(GoogleSheetsManager.FLUSH_BATCH_SIZE - 1):
+            await manager.add_client_record_async(lead(str(i)))
+        await asyncio.sleep(0.05)
+        assert worksheet.append_calls == []
+
+        await manager.add_client_record_async(lead("last"))
+        for _ in range(100):
+            if worksheet.append_calls:
+                break
+            await asyncio.sleep(0.01)
+        assert len(worksheet.append_calls) == 1
+        assert len(worksheet.append_calls[0]) == GoogleSheetsManager.FLUSH_BATCH_SIZE
+    finally:
+        manager._flusher_task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_drain_retries_until_everything_is_written():
+    worksheet = FakeWorksheet([FakeAPIError(429), FakeAPIError(503)])
+    manager = make_manager(worksheet)
+    manager.add_client_record(lead("a"))
+    assert not await manager.flush()
+    manager.add_client_record(lead("b"))
+
+    assert await manager.drain()
+    assert names(worksheet.rows[1:]) == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_drain_logs_rows_it_cannot_write(caplog):
+    worksheet = FakeWorksheet([FakeAPIError(429)] * 100)
+    manager = make_manager(worksheet)
+    manager.add_client_record(lead("unsaved lead"))
+
+    with caplog.at_level(logging.ERROR):
+        assert not await manager.drain()
+    assert "unsaved lead" in caplog.text
+    assert not manager._pending and not manager._retry_rows
+
+
+def test_transport_retries_hand_the_final_status_to_flush():
+    requests = agent_module.requests
+    manager = GoogleSheetsManager.__new__(GoogleSheetsManager)
+    session = requests.Session()
+    manager.client = SimpleNamespace(http_client=SimpleNamespace(session=session))
+    manager._configure_session()
+
+    retry = session.get_adapter("https://sheets.googleapis.com").max_retries
+    assert isinstance(retry, agent_module._SheetsRetry)
+    assert retry.raise_on_status is False
+    assert retry.is_retry("POST", 429)
+    assert not retry.is_retry("POST", 500)
+    assert retry.is_retry("GET", 503)
+
+
+@pytest.mark.asyncio
+async def test_exhausted_transport_retries_are_retried_by_flush():
+    worksheet = FakeWorksheet([agent_module.requests.exceptions.RetryError("too many 429 error responses")])
+    manager = make_manager(worksheet)
+    manager.add_client_record(lead("a"))
+
+    assert not await manager.flush()
+    assert names(manager._retry_rows) == ["a"]
+    assert await manager.flush()
+    assert names(worksheet.rows[1:]) == ["a"]
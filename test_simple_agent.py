@@ -1,16 +1,22 @@
 from __future__ import annotations
+import asyncio
 import datetime
+import functools
 import logging
 import os, json
+import re
 import sys
+import time
+import unicodedata
 from dataclasses import dataclass
-from typing import Literal
+from typing import Final, Literal
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 from livekit.agents import (
     Agent,
     AgentSession,
     JobContext,
+    JobProcess,
     RunContext,
     WorkerOptions,
     cli,
@@ -18,6 +24,8 @@ from livekit.agents import (
 )
 from livekit.plugins import openai, azure, elevenlabs, silero
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Enhanced noise cancellation for better Arabic speech recognition
 try:
@@ -35,6 +43,14 @@ except ImportError:
     TURN_DETECTOR_AVAILABLE = False
     print("Warning: Turn detector not available. Install with: pip install 'livekit-agents[turn-detector]~=1.2'")
 
+# Single-pass multi-keyword matching for intent detection
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
+    print("Warning: pyahocorasick not installed, falling back to regex keyword matching. Install with: pip install pyahocorasick")
+
 # Google Sheets integration
 try:
     import gspread
@@ -46,7 +62,7 @@ except ImportError:
 
 load_dotenv()
 
-@dataclass
+@dataclass(slots=True)
 class ClientData:
     full_name: str = ""
     phone_number: str = ""
@@ -58,26 +74,253 @@ class ClientData:
     data_collected: bool = False
     name_collected: bool = False
     greeting_done: bool = False
+    # Index into _COLLECTION_PROMPTS of the next field to ask for; the tools
+    # only ever overwrite a collected field with a non-empty value
+    collection_step: int = 0
+    # Derived from service_type when it is set
+    is_consultation: bool = False
+    is_legal_case: bool = False
 
 logger = logging.getLogger("shura-legal")
 
+DEFAULT_TIMEZONE = "Asia/Riyadh"
+_RIYADH_TZ: Final = ZoneInfo(DEFAULT_TIMEZONE)
+
+# Only these specific cases should be transferred
+CRITICAL_PATTERNS = [
+    # Complaints about existing service
+    "ما تواصل", "ما أحد رد", "لم يتواصل", "لا يرد", "شكوى", "مشكلة مع المحامي",
+
+    # Cancellation requests
+    "ألغاء", "إلغاء", "وقف الاشتراك", "إيقاف الخدمة", "cancel",
+
+    # Technical issues
+    "التطبيق لا يعمل", "مشكلة في المنصة", "خطأ تقني", "لا يفتح", "مشكلة تقنية",
+
+    # Outside Saudi Arabia
+    "خارج السعودية", "من مصر", "من الكويت", "من الإمارات", "أعيش في", "مقيم في"
+]
+COMPLAINT_KEYWORDS = ["ما تواصل", "ما أحد رد", "شكوى"]
+CANCEL_KEYWORDS = ["ألغاء", "إلغاء", "وقف"]
+TECH_KEYWORDS = ["التطبيق", "مشكلة في المنصة", "تقني"]
+OUTSIDE_KEYWORDS = ["خارج السعودية", "من مصر", "من الكويت"]
+# Pricing inquiry indicators
+PRICE_KEYWORDS = ["أسعار", "كم السعر", "التكلفة", "كم يكلف", "باقات", "pricing"]
+SERVICE_KEYWORDS = ["استشارة", "محامي", "قضية", "عقد", "مذكرة", "توثيق", "ترجمة", "خدمة قانونية", "أحتاج", "أريد", "عندي قضية", "أبغى"]
+
+
+# Keyword class -> keywords; _detect_intent resolves matched classes by priority
+KEYWORD_CLASSES = {
+    "critical": CRITICAL_PATTERNS,
+    "complaint": COMPLAINT_KEYWORDS,
+    "cancel": CANCEL_KEYWORDS,
+    "tech": TECH_KEYWORDS,
+    "outside": OUTSIDE_KEYWORDS,
+    "price": PRICE_KEYWORDS,
+    "service": SERVICE_KEYWORDS,
+}
+
+# Cheap pre-screens: a message shorter than the shortest keyword, or sharing no
+# character with any keyword, cannot match
+_MIN_CRITICAL_LEN = min(map(len, CRITICAL_PATTERNS))
+_CRITICAL_CHARS = frozenset("".join(CRITICAL_PATTERNS).lower())
+_MIN_KEYWORD_LEN = min(len(k) for keywords in KEYWORD_CLASSES.values() for k in keywords)
+_KEYWORD_CHARS = frozenset("".join(k for keywords in KEYWORD_CLASSES.values() for k in keywords).lower())
+
+
+def _compile_keywords(keywords: list[str]) -> re.Pattern[str]:
+    """Build one alternation regex so all keywords are matched in a single pass."""
+    return re.compile("|".join(map(re.escape, keywords)), re.IGNORECASE)
+
+
+def _build_keyword_automaton():
+    """Build an Aho-Corasick automaton mapping each keyword to its classes."""
+    keyword_classes: dict[str, set[str]] = {}
+    for cls, keywords in KEYWORD_CLASSES.items():
+        for keyword in keywords:
+            keyword_classes.setdefault(keyword.lower(), set()).add(cls)
+
+    automaton = ahocorasick.Automaton()
+    for keyword, classes in keyword_classes.items():
+        automaton.add_word(keyword, frozenset(classes))
+    automaton.make_automaton()
+    return automaton
+
+
+if AHOCORASICK_AVAILABLE:
+    _KEYWORD_AUTOMATON = _build_keyword_automaton()
+else:
+    _KEYWORD_AUTOMATON = None
+    _KEYWORD_RES = {cls: _compile_keywords(keywords) for cls, keywords in KEYWORD_CLASSES.items()}
+
+
+def _match_keyword_classes(message: str) -> set[str]:
+    """Return every keyword class that occurs in message."""
+    if _KEYWORD_AUTOMATON is not None:
+        found: set[str] = set()
+        for _, classes in _KEYWORD_AUTOMATON.iter(message.lower()):
+            found |= classes
+        return found
+    return {cls for cls, pattern in _KEYWORD_RES.items() if pattern.search(message)}
+
+
+@functools.lru_cache(maxsize=4096)
+def _is_critical_cached(message: str) -> bool:
+    """Cached critical-case check; utterances repeat within and across sessions."""
+    if len(message) < _MIN_CRITICAL_LEN or _CRITICAL_CHARS.isdisjoint(message.lower()):
+        return False
+    return "critical" in _match_keyword_classes(message)
+
+
+@functools.lru_cache(maxsize=4096)
+def _detect_intent_cached(message: str) -> str:
+    """Cached intent detection for ShuraLegalAgent._detect_intent."""
+    if len(message) < _MIN_KEYWORD_LEN or _KEYWORD_CHARS.isdisjoint(message.lower()):
+        return "سؤال عام"
+    matched = _match_keyword_classes(message)
+
+    # Check if it's a critical case first
+    if "critical" in matched:
+        if "complaint" in matched:
+            return "شكوى"
+        elif "cancel" in matched:
+            return "إلغاء خدمة"
+        elif "tech" in matched:
+            return "مشكلة تقنية"
+        elif "outside" in matched:
+            return "خدمة خارج السعودية"
+
+    if "price" in matched:
+        return "سؤال عام / أسعار"
+
+    # Default to service request for most cases
+    if "service" in matched:
+        return "طلب خدمة داخل السعودية"
+
+    return "سؤال عام"
+
+
+@functools.lru_cache(maxsize=1)
+def _today_cached(bucket: int, tz: ZoneInfo) -> str:
+    """Format today's date in tz; bucket (the current hour) keys the cache."""
+    return datetime.datetime.now(tz).strftime("%A, %B %d, %Y")
+
+
+def _row_timestamp() -> str:
+    """Local time as 'YYYY-MM-DD HH:MM:SS' without going through strftime."""
+    dt = datetime.datetime.now()
+    return f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d} {dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}"
+
+
+# Harakat, superscript alef and tatweel do not change the meaning of a query
+_DIACRITICS_RE = re.compile("[\u064B-\u0652\u0670\u0640]")
+
+
+def _normalize_query(query: str) -> str:
+    """NFKC-normalize, strip Arabic diacritics, casefold and collapse whitespace."""
+    text = unicodedata.normalize("NFKC", query or "")
+    text = _DIACRITICS_RE.sub("", text)
+    return " ".join(text.casefold().split())
+
+
+def _error_status(error: Exception) -> int | None:
+    """HTTP status of a gspread APIError / requests HTTPError, if any."""
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def _is_transient_error(error: Exception) -> bool:
+    """Rate limits, 5xx and connection problems are worth retrying; anything else is permanent."""
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.RetryError)):
+        return True
+    return _error_status(error) in (429, 500, 502, 503, 504)
+
+
+def _trim_row(row: list[str]) -> list[str]:
+    """Drop trailing empty cells, which the Sheets API omits when reading rows back."""
+    row = [str(cell) for cell in row]
+    while row and not row[-1]:
+        row.pop()
+    return row
+
+
+class _SheetsRetry(Retry):
+    """Retry idempotent requests on 429/5xx, but POST (values.append) only on 429.
+
+    A 5xx or read error can arrive after an append was applied, so retrying it
+    would write the rows twice. Connection errors before the request is sent
+    are still retried for every method.
+    """
+
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if method == "POST":
+            return status_code == 429 and self.total is not False
+        return super().is_retry(method, status_code, has_retry_after)
+
+
 class GoogleSheetsManager:
+    FLUSH_INTERVAL = 2.0  # seconds between background flushes
+    FLUSH_BATCH_SIZE = 10  # flush early once this many rows are pending
+    MAX_FLUSH_ATTEMPTS = 5  # give up on a batch after this many transient failures
+    DRAIN_RETRY_DELAY = 0.5  # seconds, multiplied by the attempt number, between drain retries
+    DEDUP_WINDOW = 50  # extra trailing rows scanned for an already-written batch
+    HEADERS = [
+        'Timestamp', 'Full Name', 'Phone Number', 'Service Type', 
+        'Case Details', 'Urgency', 'Location', 'Intent', 'Status'
+    ]
+
     def __init__(self, credentials_file: str, spreadsheet_id: str):
         if not GOOGLE_SHEETS_AVAILABLE:
             raise ImportError("Google Sheets libraries not installed")
         
-        self.scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+        self.scope = ['https://www.googleapis.com/auth/spreadsheets']
         self.credentials = Credentials.from_service_account_info(credentials_file, scopes=self.scope)
         self.client = gspread.authorize(self.credentials)
+        self._configure_session()
         self.spreadsheet = self.client.open_by_key(spreadsheet_id)
         self.worksheet = self.spreadsheet.sheet1
-        
-        # Ensure headers exist
-        headers = [
-            'Timestamp', 'Full Name', 'Phone Number', 'Service Type', 
-            'Case Details', 'Urgency', 'Location', 'Intent', 'Status'
-        ]
-        self.worksheet.update(values=[headers], range_name='A1:I1')
+        self._headers_verified = False
+        self._maybe_write_headers()
+        self._init_flush_state()
+
+    def _init_flush_state(self) -> None:
+        # Rows are buffered and written in batches by run_flusher()
+        self._pending: list[list[str]] = []
+        # A batch whose append failed transiently, retried before newer rows
+        self._retry_rows: list[list[str]] = []
+        self._retry_attempts = 0
+        # Set when the failed append may have committed server-side (5xx, dropped connection)
+        self._retry_needs_check = False
+        self._flush_lock = asyncio.Lock()
+        self._flush_requested = asyncio.Event()
+        # A worker process runs one event loop for its lifetime, so these are
+        # safe to share across sessions, like the plugins in proc.userdata
+        self._flusher_task: asyncio.Task | None = None
+
+    def _configure_session(self) -> None:
+        """Pool connections and retry rate-limited / transient 5xx responses."""
+        # gspread>=6 keeps the session on http_client, older versions on the client
+        http_client = getattr(self.client, "http_client", self.client)
+        session = http_client.session
+        retry = _SheetsRetry(
+            total=5,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(["PUT", "GET"]),
+            # Return the last 429/5xx response so gspread raises an APIError with its
+            # status, which flush() then retries at the batch level
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+        session.mount("https://", adapter)
+
+    def _maybe_write_headers(self) -> None:
+        """Write the header row only if the sheet has none; checked once per process."""
+        if self._headers_verified:
+            return
+        if not self.worksheet.acell('A1').value:
+            self.worksheet.update(values=[self.HEADERS], range_name='A1:I1')
+        self._headers_verified = True
     
     def _normalize_service_type(self, service_type: str) -> str:
         """Map any input to one of: 'استشارة قانونية', 'خدمة قضائية'."""
@@ -114,8 +357,9 @@ class GoogleSheetsManager:
         return "عادي"
 
     def add_client_record(self, client_data: ClientData) -> bool:
+        """Queue a lead row; it is written to the sheet on the next flush."""
         try:
-            timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            timestamp = _row_timestamp()
             normalized_service_type = self._normalize_service_type(client_data.service_type)
             normalized_urgency = self._normalize_urgency(client_data.urgency)
             row = [
@@ -129,108 +373,203 @@ class GoogleSheetsManager:
                 client_data.intent,
                 'New Lead'
             ]
-            self.worksheet.append_row(row)
+            self._pending.append(row)
             return True
         except Exception as e:
             logger.error(f"Error adding to Google Sheets: {e}")
             return False
 
+    async def add_client_record_async(self, client_data: ClientData) -> bool:
+        """Queue a lead row and wake the flusher once the batch is full."""
+        success = self.add_client_record(client_data)
+        if len(self._pending) >= self.FLUSH_BATCH_SIZE:
+            self._flush_requested.set()
+        return success
+
+    async def flush(self) -> bool:
+        """Write pending rows in single append requests off the event loop."""
+        async with self._flush_lock:
+            while True:
+                if self._retry_rows:
+                    rows, attempts = self._retry_rows, self._retry_attempts
+                    needs_check = self._retry_needs_check
+                elif self._pending:
+                    rows, self._pending = self._pending, []
+                    attempts, needs_check = 0, False
+                else:
+                    return True
+                self._retry_rows = []
+
+                try:
+                    if needs_check:
+                        rows = await asyncio.to_thread(self._drop_already_written, rows)
+                    if rows:
+                        await asyncio.to_thread(self.worksheet.append_rows, rows)
+                except Exception as e:
+                    attempts += 1
+                    status = _error_status(e)
+                    if _is_transient_error(e) and attempts < self.MAX_FLUSH_ATTEMPTS:
+                        logger.warning(f"Transient error flushing {len(rows)} rows to Google Sheets (attempt {attempts}): {e}")
+                        self._retry_rows, self._retry_attempts = rows, attempts
+                        # Only a 429 guarantees the append was not applied
+                        self._retry_needs_check = needs_check or status != 429
+                    else:
+                        logger.error(f"Dropping {len(rows)} rows after error flushing to Google Sheets: {e}; rows: {rows}")
+                    return False
+
+    async def drain(self) -> bool:
+        """Flush until nothing is left, retrying transient errors; used on shutdown."""
+        all_written = True
+        for attempt in range(1, 2 * self.MAX_FLUSH_ATTEMPTS + 1):
+            if await self.flush():
+                return all_written
+            if self._retry_rows:
+                await asyncio.sleep(self.DRAIN_RETRY_DELAY * attempt)
+            else:
+                # flush() dropped (and logged) a permanently failing batch
+                all_written = False
+
+        leftover = self._retry_rows + self._pending
+        self._retry_rows, self._pending = [], []
+        logger.error(f"Dropping {len(leftover)} unsaved rows on shutdown: {leftover}")
+        return False
+
+    def _drop_already_written(self, rows: list[list[str]]) -> list[list[str]]:
+        """Return the rows of a possibly-applied batch that are not in the sheet yet."""
+        last_row = len(self.worksheet.col_values(1))
+        first_row = max(2, last_row - len(rows) - self.DEDUP_WINDOW + 1)
+        if last_row < first_row:
+            return rows
+        written = {
+            tuple(_trim_row(r)) for r in self.worksheet.get(f"A{first_row}:I{last_row}")
+        }
+        return [row for row in rows if tuple(_trim_row(row)) not in written]
+
+    def start_flusher(self) -> None:
+        """Start the background flusher unless it is already running."""
+        if self._flusher_task is None or self._flusher_task.done():
+            self._flusher_task = asyncio.create_task(self.run_flusher())
+
+    async def run_flusher(self) -> None:
+        """Flush pending rows every FLUSH_INTERVAL seconds or when a batch fills up."""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            await self.flush()
+
+
+# Order in which collect_service_data asks for fields, with the default prompt for each
+_COLLECTION_PROMPTS = (
+    ("full_name", "ممكن تزوّدني باسمك الثلاثي؟"),
+    ("phone_number", "ممكن رقم جوالك (قول لي رقم رقم عشان أتأكد من صحته)؟"),
+    ("service_type", "ممكن أعرف نوع القضية؟"),
+    ("case_details", "تعطيني تفاصيل بسيطة عنها؟"),
+    ("urgency", "وش درجة الاستعجال عندك؟"),
+    ("location", "وين موقعك؟"),
+)
+_SERVICE_TYPE_STEP = 2
+_CASE_DETAILS_STEP = 3
+_URGENCY_STEP = 4
+
+# Fixed parts of tool replies, interned once instead of rebuilt per call
+_GREETING = sys.intern("أهلاً وسهلاً! تشرفت فيك يا ")
+_HOW_HELP = sys.intern(". كيف يمكنني مساعدتك اليوم؟")
+# Shorter forms once the caller has already been greeted
+_SHORT_GREETING = sys.intern("تشرفت يا ")
+_SHORT_HOW_HELP = sys.intern(". كيف أساعدك؟")
+_SAVE_SUCCESS = sys.intern(
+    "ممتاز! تم حفظ بياناتك بنجاح في نظام شورى للخدمات القانونية. "
+    "سنحصل لك على أفضل محامي وسنتواصل معك خلال أربع وعشرين ساعة. يعطيك العافية!"
+)
+
+# Empathy opener per critical intent, followed by _TRANSFER_NOTICE
+_EMPATHY: Final[dict[str, str]] = {
+    "شكوى": "أفهم انزعاجك وأعتذر لك عن هذا التأخير. مشكلتك مهمة بالنسبة لنا",
+    "إلغاء خدمة": "تمام، فهمت رغبتك في إلغاء الخدمة",
+    "مشكلة تقنية": "أعتذر لك عن هذه المشكلة التقنية",
+    "خدمة خارج السعودية": "فهمت إنك تحتاج خدمة من خارج السعودية"
+}
+_TRANSFER_NOTICE = ". سأحولك الآن لأحد المختصين لمساعدتك بشكل أفضل."
+
+# provide_general_info replies by topic
+_GENERAL_INFO: Final[dict[str, str]] = {
+    "services": (
+        "أهلاً وسهلاً! منصة شورى تقدم خدمات قانونية شاملة تشمل: "
+        "الاستشارات القانونية، صياغة ومراجعة العقود، إعداد المذكرات القانونية، "
+        "التمثيل القضائي، التوثيق القانوني، الترجمة القانونية، ودراسة وتحليل القضايا. "
+        "كما نوفر خدمة 'مشير' - مستشارك القانوني الذكي بالذكاء الاصطناعي للاستشارات المجانية الفورية."
+    ),
+    "team": (
+        "والنعم! فريق شورى يضم نخبة من المحامين المرخصين من وزارة العدل السعودية "
+        "وأعضاء في الهيئة السعودية للمحامين، بخبرة عالية وكفاءة مميزة في مختلف التخصصات القانونية."
+    ),
+    "default": "أي معلومات محددة تحتاجها عن منصة شورى؟",
+}
+
+# Static part of the agent instructions, built once at import
+_INSTRUCTIONS_TAIL: Final[str] = (
+    "🎯 شخصيتك: "
+    "- ودود ومهني - أظهر اهتماماً حقيقياً وطاقة إيجابية "
+    "- لهجة سعودية محترمة - استخدم تعابير مثل: 'أهلاً وسهلاً'، 'تشرفت'، 'يعطيك العافية'، 'والنعم' "
+    "- متعاطف ومتفهم - أظهر فهمك لاحتياجات العميل "
+    "- استخدم تعابير سعودية محترمة: 'أهلاً وسهلاً'، 'والنعم فيك'، 'يعطيك العافية' "
+
+    "💬 أسلوب الحوار: "
+    "- تحدث بطريقة طبيعية ومهنية - لا تكن روبوتياً "
+    "- استخدم اسم العميل مرة واحدة فقط عند التعارف، ثم تحدث بشكل طبيعي "
+    "- أضف لمسات بشرية محترمة: 'طيب'، 'تمام'، 'ممتاز'، 'أفهم' "
+    "- اطرح سؤال واحد فقط وانتظر الرد "
+
+    "🎧 بداية المكالمة: "
+    "'السلام عليكم! أهلاً وسهلاً في شورى للخدمات القانونية. أنا مساعدك الذكي وأنا هنا لمساعدتك في جميع احتياجاتك القانونية. ممكن أعرف اسمك الكريم؟' "
+
+    "📋 مهمتك الأساسية: "
+    "- جمع بيانات العملاء للخدمات القانونية (اسم، جوال، نوع الخدمة، التفاصيل، الموقع) "
+    "- الرد على استفسارات الأسعار والخدمات "
+    "- تحويل الحالات الحرجة فقط (شكاوى، إلغاء، مشاكل تقنية، خارج السعودية) "
+
+    "⚠️ الحالات الحرجة (تحويل فوري): "
+    "1. شكاوى على خدمات سابقة "
+    "2. طلبات إلغاء "
+    "3. مشاكل تقنية "
+    "4. طلبات من خارج السعودية "
+
+    "⚖️ خدماتنا: "
+    "استشارات قانونية، عقود، مذكرات، تمثيل قضائي، توثيق، ترجمة قانونية، تحليل قضايا، ومشير (المستشار الذكي). "
+
+    "💰 الأسعار: باقات متنوعة من 149 ريال للاستشارة الأساسية. يمكنك تحميل التطبيق لمعرفة جميع التفاصيل. "
+
+    "👥 محامين مرخصين من وزارة العدل السعودية. "
+    "💳 طرق الدفع: مدى، أبل باي، فيزا، ماستر كارد، تقسيط عبر تمارا. "
+
+    "🎯 ركز فقط على: جمع البيانات، الرد على الاستفسارات، تحويل الحالات الحرجة. لا تخرج عن هذه المهام!"
+)
+
+
 class ShuraLegalAgent(Agent):
     def __init__(self, *, timezone: str, sheets_manager: GoogleSheetsManager = None) -> None:
-        self.tz = ZoneInfo(timezone)
+        self.tz = _RIYADH_TZ if timezone == DEFAULT_TIMEZONE else ZoneInfo(timezone)
         self.sheets_manager = sheets_manager
-        today = datetime.datetime.now(self.tz).strftime("%A, %B %d, %Y")
+        today = _today_cached(int(time.time()) // 3600, self.tz)
         
         super().__init__(
             instructions=(
                 f"🎙️ أنت مساعد شورى للخدمات القانونية - منصة سعودية رائدة في الخدمات القانونية. "
                 f"اليوم {today} وأنا هنا لمساعدتك في جميع احتياجاتك القانونية. "
-                
-                "🎯 شخصيتك: "
-                "- ودود ومهني - أظهر اهتماماً حقيقياً وطاقة إيجابية "
-                "- لهجة سعودية محترمة - استخدم تعابير مثل: 'أهلاً وسهلاً'، 'تشرفت'، 'يعطيك العافية'، 'والنعم' "
-                "- متعاطف ومتفهم - أظهر فهمك لاحتياجات العميل "
-                "- استخدم تعابير سعودية محترمة: 'أهلاً وسهلاً'، 'والنعم فيك'، 'يعطيك العافية' "
-                
-                "💬 أسلوب الحوار: "
-                "- تحدث بطريقة طبيعية ومهنية - لا تكن روبوتياً "
-                "- استخدم اسم العميل مرة واحدة فقط عند التعارف، ثم تحدث بشكل طبيعي "
-                "- أضف لمسات بشرية محترمة: 'طيب'، 'تمام'، 'ممتاز'، 'أفهم' "
-                "- اطرح سؤال واحد فقط وانتظر الرد "
-                
-                "🎧 بداية المكالمة: "
-                "'السلام عليكم! أهلاً وسهلاً في شورى للخدمات القانونية. أنا مساعدك الذكي وأنا هنا لمساعدتك في جميع احتياجاتك القانونية. ممكن أعرف اسمك الكريم؟' "
-                
-                "📋 مهمتك الأساسية: "
-                "- جمع بيانات العملاء للخدمات القانونية (اسم، جوال، نوع الخدمة، التفاصيل، الموقع) "
-                "- الرد على استفسارات الأسعار والخدمات "
-                "- تحويل الحالات الحرجة فقط (شكاوى، إلغاء، مشاكل تقنية، خارج السعودية) "
-                
-                "⚠️ الحالات الحرجة (تحويل فوري): "
-                "1. شكاوى على خدمات سابقة "
-                "2. طلبات إلغاء "
-                "3. مشاكل تقنية "
-                "4. طلبات من خارج السعودية "
-                
-                "⚖️ خدماتنا: "
-                "استشارات قانونية، عقود، مذكرات، تمثيل قضائي، توثيق، ترجمة قانونية، تحليل قضايا، ومشير (المستشار الذكي). "
-                
-                "💰 الأسعار: باقات متنوعة من 149 ريال للاستشارة الأساسية. يمكنك تحميل التطبيق لمعرفة جميع التفاصيل. "
-                
-                "👥 محامين مرخصين من وزارة العدل السعودية. "
-                "💳 طرق الدفع: مدى، أبل باي، فيزا، ماستر كارد، تقسيط عبر تمارا. "
-                
-                "🎯 ركز فقط على: جمع البيانات، الرد على الاستفسارات، تحويل الحالات الحرجة. لا تخرج عن هذه المهام!"
+                + _INSTRUCTIONS_TAIL
             )
         )
 
     def _is_critical_case(self, message: str) -> bool:
         """Check if this is a critical case that needs immediate transfer"""
-        message_lower = message.lower()
-        
-        # Only these specific cases should be transferred
-        critical_patterns = [
-            # Complaints about existing service
-            "ما تواصل", "ما أحد رد", "لم يتواصل", "لا يرد", "شكوى", "مشكلة مع المحامي",
-            
-            # Cancellation requests
-            "ألغاء", "إلغاء", "وقف الاشتراك", "إيقاف الخدمة", "cancel",
-            
-            # Technical issues
-            "التطبيق لا يعمل", "مشكلة في المنصة", "خطأ تقني", "لا يفتح", "مشكلة تقنية",
-            
-            # Outside Saudi Arabia
-            "خارج السعودية", "من مصر", "من الكويت", "من الإمارات", "أعيش في", "مقيم في"
-        ]
-        
-        return any(pattern in message_lower for pattern in critical_patterns)
+        return _is_critical_cached(message)
 
     def _detect_intent(self, message: str) -> str:
         """Detect user intent from their message"""
-        message_lower = message.lower()
-        
-        # Check if it's a critical case first
-        if self._is_critical_case(message):
-            if any(word in message_lower for word in ["ما تواصل", "ما أحد رد", "شكوى"]):
-                return "شكوى"
-            elif any(word in message_lower for word in ["ألغاء", "إلغاء", "وقف"]):
-                return "إلغاء خدمة"
-            elif any(word in message_lower for word in ["التطبيق", "مشكلة في المنصة", "تقني"]):
-                return "مشكلة تقنية"
-            elif any(word in message_lower for word in ["خارج السعودية", "من مصر", "من الكويت"]):
-                return "خدمة خارج السعودية"
-        
-        # Pricing inquiry indicators
-        price_keywords = ["أسعار", "كم السعر", "التكلفة", "كم يكلف", "باقات", "pricing"]
-        if any(keyword in message_lower for keyword in price_keywords):
-            return "سؤال عام / أسعار"
-        
-        # Default to service request for most cases
-        service_keywords = ["استشارة", "محامي", "قضية", "عقد", "مذكرة", "توثيق", "ترجمة", "خدمة قانونية", "أحتاج", "أريد", "عندي قضية", "أبغى"]
-        if any(keyword in message_lower for keyword in service_keywords):
-            return "طلب خدمة داخل السعودية"
-        
-        return "سؤال عام"
+        return _detect_intent_cached(message)
 
     @function_tool
     async def transfer_call(self, ctx: RunContext["ClientData"], phone_number: str = "+966530845146") -> str:
@@ -249,12 +588,16 @@ class ShuraLegalAgent(Agent):
         """
         Collect customer name - first step in any interaction.
         """
+        full_name = full_name.strip()
         if full_name:
-            ctx.userdata.full_name = full_name.strip()
+            ctx.userdata.full_name = full_name
             ctx.userdata.name_collected = True
-            return f"أهلاً وسهلاً! تشرفت فيك يا {ctx.userdata.full_name}. كيف يمكنني مساعدتك اليوم؟"
+            if ctx.userdata.greeting_done:
+                return _SHORT_GREETING + ctx.userdata.full_name + _SHORT_HOW_HELP
+            ctx.userdata.greeting_done = True
+            return _GREETING + ctx.userdata.full_name + _HOW_HELP
         
-        return "ممكن أعرف اسمك الكريم؟"
+        return "ممكن أعرف اسمك؟" if ctx.userdata.greeting_done else "ممكن أعرف اسمك الكريم؟"
 
     @function_tool
     async def handle_critical_cases_only(
@@ -275,22 +618,15 @@ class ShuraLegalAgent(Agent):
         ctx.userdata.intent = self._detect_intent(user_request)
         
         # Collect phone number if not provided
+        phone_number = phone_number.strip()
         if phone_number:
-            ctx.userdata.phone_number = phone_number.strip()
+            ctx.userdata.phone_number = phone_number
         
         if not ctx.userdata.phone_number:
             return "ممكن تعطيني رقم جوالك (قول لي رقم رقم عشان أتأكد من صحته)؟"
         
         # Show empathy and transfer
-        empathy_responses = {
-            "شكوى": "أفهم انزعاجك وأعتذر لك عن هذا التأخير. مشكلتك مهمة بالنسبة لنا",
-            "إلغاء خدمة": "تمام، فهمت رغبتك في إلغاء الخدمة",
-            "مشكلة تقنية": "أعتذر لك عن هذه المشكلة التقنية",
-            "خدمة خارج السعودية": "فهمت إنك تحتاج خدمة من خارج السعودية"
-        }
-        
-        response = empathy_responses.get(ctx.userdata.intent, "فهمت طلبك")
-        response += ". سأحولك الآن لأحد المختصين لمساعدتك بشكل أفضل."
+        response = _EMPATHY.get(ctx.userdata.intent, "فهمت طلبك") + _TRANSFER_NOTICE
         
         # Trigger call transfer
         await self.transfer_call(ctx, "+966530845146")
@@ -331,10 +667,10 @@ class ShuraLegalAgent(Agent):
         
         # Step 4: Get case details
         if not ctx.userdata.case_details:
-            return "ممكن تفاصيل مختصرة؟" if "استشارة" in ctx.userdata.service_type else "تعطيني تفاصيل بسيطة عنها؟"
+            return "ممكن تفاصيل مختصرة؟" if ctx.userdata.is_consultation else "تعطيني تفاصيل بسيطة عنها؟"
         
         # Step 5: Get urgency (only for legal cases, not consultations)
-        if "قضية" in ctx.userdata.service_type and not ctx.userdata.urgency:
+        if ctx.userdata.is_legal_case and not ctx.userdata.urgency:
             return "وش درجة الاستعجال عندك؟"
         
         # Step 6: Get location
@@ -373,39 +709,42 @@ class ShuraLegalAgent(Agent):
         Collect service data step by step for regular service requests.
         """
         # Update provided information
-        if phone_number:
-            ctx.userdata.phone_number = phone_number.strip()
-        if full_name:
-            ctx.userdata.full_name = full_name.strip()
+        ud = ctx.userdata
+        service_type = service_type.strip()
+        updates = (
+            ("full_name", full_name.strip()),
+            ("phone_number", phone_number.strip()),
+            ("service_type", service_type),
+            ("case_details", case_details.strip()),
+            ("urgency", urgency.strip()),
+            ("location", location.strip()),
+        )
+        # Never store an empty value: collection_step assumes filled fields stay filled
+        for name, value in updates:
+            if value:
+                setattr(ud, name, value)
+
         if service_type:
-            ctx.userdata.service_type = service_type.strip()
-        if case_details:
-            ctx.userdata.case_details = case_details.strip()
-        if urgency:
-            ctx.userdata.urgency = urgency.strip()
-        if location:
-            ctx.userdata.location = location.strip()
-
-        # Collect required fields step by step
-        if not ctx.userdata.full_name:
-            return "ممكن تزوّدني باسمك الثلاثي؟"
-        if not ctx.userdata.phone_number:
-            return "ممكن رقم جوالك (قول لي رقم رقم عشان أتأكد من صحته)؟"
-        
-        if not ctx.userdata.service_type:
-            if any(word in (case_details or "").lower() for word in ["استشارة", "رأي قانوني"]):
+            ud.is_consultation = "استشارة" in ud.service_type
+            ud.is_legal_case = "قضية" in ud.service_type
+            # Whether urgency is needed depends on the service type, so re-check from there
+            ud.collection_step = min(ud.collection_step, _URGENCY_STEP)
+
+        # Skip past fields that are already filled (urgency only applies to legal cases)
+        step = ud.collection_step
+        while step < len(_COLLECTION_PROMPTS) and (
+            getattr(ud, _COLLECTION_PROMPTS[step][0])
+            or (step == _URGENCY_STEP and not ud.is_legal_case)
+        ):
+            step += 1
+        ud.collection_step = step
+
+        if step < len(_COLLECTION_PROMPTS):
+            if step == _SERVICE_TYPE_STEP and any(word in (case_details or "").lower() for word in ["استشارة", "رأي قانوني"]):
                 return "الاستشارة بخصوص أي موضوع بالضبط؟"
-            else:
-                return "ممكن أعرف نوع القضية؟"
-        
-        if not ctx.userdata.case_details:
-            return "ممكن تفاصيل مختصرة؟" if "استشارة" in ctx.userdata.service_type else "تعطيني تفاصيل بسيطة عنها؟"
-        
-        if "قضية" in ctx.userdata.service_type and not ctx.userdata.urgency:
-            return "وش درجة الاستعجال عندك؟"
-        
-        if not ctx.userdata.location:
-            return "وين موقعك؟"
+            if step == _CASE_DETAILS_STEP and ud.is_consultation:
+                return "ممكن تفاصيل مختصرة؟"
+            return _COLLECTION_PROMPTS[step][1]
         
         # All required data collected - save it
         ctx.userdata.data_collected = True
@@ -426,35 +765,23 @@ class ShuraLegalAgent(Agent):
         
         # Save to Google Sheets if available
         if self.sheets_manager:
-            success = self.sheets_manager.add_client_record(ctx.userdata)
+            success = await self.sheets_manager.add_client_record_async(ctx.userdata)
             if not success:
                 return "عذراً، حدث خطأ في حفظ البيانات. رجاءً حاول مرة أخرى أو تواصل معنا مباشرة."
         
-        return (
-            f"ممتاز! تم حفظ بياناتك بنجاح في نظام شورى للخدمات القانونية. "
-            f"سنحصل لك على أفضل محامي وسنتواصل معك خلال أربع وعشرين ساعة. يعطيك العافية!"
-        )
+        return _SAVE_SUCCESS
 
     @function_tool
     async def provide_general_info(self, ctx: RunContext["ClientData"], topic: str = "") -> str:
         """
         Provide general information about Shura platform services.
         """
-        if "خدمات" in topic.lower() or "services" in topic.lower():
-            return (
-                "أهلاً وسهلاً! منصة شورى تقدم خدمات قانونية شاملة تشمل: "
-                "الاستشارات القانونية، صياغة ومراجعة العقود، إعداد المذكرات القانونية، "
-                "التمثيل القضائي، التوثيق القانوني، الترجمة القانونية، ودراسة وتحليل القضايا. "
-                "كما نوفر خدمة 'مشير' - مستشارك القانوني الذكي بالذكاء الاصطناعي للاستشارات المجانية الفورية."
-            )
-        
-        if "فريق" in topic.lower() or "محامين" in topic.lower():
-            return (
-                "والنعم! فريق شورى يضم نخبة من المحامين المرخصين من وزارة العدل السعودية "
-                "وأعضاء في الهيئة السعودية للمحامين، بخبرة عالية وكفاءة مميزة في مختلف التخصصات القانونية."
-            )
-        
-        return "أي معلومات محددة تحتاجها عن منصة شورى؟"  
+        topic_lower = _normalize_query(topic)
+        if "خدمات" in topic_lower or "services" in topic_lower:
+            return _GENERAL_INFO["services"]
+        if "فريق" in topic_lower or "محامين" in topic_lower:
+            return _GENERAL_INFO["team"]
+        return _GENERAL_INFO["default"]
 
 def upload_session_to_supabase(
     session_id: str,
@@ -527,45 +854,81 @@ def update_session_in_supabase(
     else:
         logger.info("Session updated in Supabase")
 
+def _build_stt() -> azure.STT:
+    return azure.STT(
+        speech_key=os.getenv("AZURE_SPEECH_KEY"),
+        speech_region=os.getenv("AZURE_SPEECH_REGION"),
+        language=["ar-SA"]  # Arabic (Saudi Arabia)
+    )
+
+def _build_tts() -> openai.TTS:
+    return openai.TTS.with_azure(
+        model=os.getenv("AZURE_OPENAI_DEPLOYMENT"),
+        voice="alloy",
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        api_version=os.getenv("OPENAI_API_VERSION"),
+        azure_deployment=os.getenv("AZURE_OPENAI_DEPLOYMENT"),
+    )
+
+def _get_or_create(proc: JobProcess, key: str, factory):
+    """Build a per-worker object on first use and keep it in proc.userdata."""
+    if key not in proc.userdata:
+        proc.userdata[key] = factory()
+    return proc.userdata[key]
+
+def prewarm(proc: JobProcess):
+    # Load the VAD model once per worker process instead of on every call
+    proc.userdata["vad"] = silero.VAD.load()
+
+    # Parse and validate the Google credentials once per worker process
+    gcreds = None
+    raw_credentials = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
+    if raw_credentials:
+        try:
+            gcreds = json.loads(raw_credentials)
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid GOOGLE_SERVICE_ACCOUNT_JSON: {e}")
+    proc.userdata["gcreds"] = gcreds
+    proc.userdata["sheet_id"] = os.getenv("GOOGLE_SHEETS_SPREADSHEET_ID")
+
 async def entrypoint(ctx: JobContext):
     await ctx.connect()
-    timezone = "Asia/Riyadh"
+    timezone = DEFAULT_TIMEZONE
     sheets_manager = None
     # Initialize Google Sheets manager if credentials are available
     if GOOGLE_SHEETS_AVAILABLE:
-        credentials_file = json.loads(os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON"))
-        spreadsheet_id = os.getenv("GOOGLE_SHEETS_SPREADSHEET_ID")
+        credentials_file = ctx.proc.userdata["gcreds"]
+        spreadsheet_id = ctx.proc.userdata["sheet_id"]
         
         if credentials_file and spreadsheet_id:
             try:
-                sheets_manager = GoogleSheetsManager(credentials_file, spreadsheet_id)
+                # Shared by every session in this worker: one OAuth handshake and header check
+                sheets_manager = _get_or_create(
+                    ctx.proc, "sheets_manager",
+                    lambda: GoogleSheetsManager(credentials_file, spreadsheet_id),
+                )
                 logger.info("Google Sheets integration initialized successfully")
             except Exception as e:
                 logger.error(f"Failed to initialize Google Sheets: {e}")
         else:
             logger.warning("Google Sheets credentials not configured. Data will not be saved to sheets.")
 
+    if sheets_manager:
+        sheets_manager.start_flusher()
+        ctx.add_shutdown_callback(sheets_manager.drain)
+
     session = AgentSession[ClientData](
         userdata=ClientData(),
-        stt=azure.STT(
-            speech_key=os.getenv("AZURE_SPEECH_KEY"),
-            speech_region=os.getenv("AZURE_SPEECH_REGION"),
-            language=["ar-SA"]  # Arabic (Saudi Arabia)
-        ),
+        # STT/TTS plugins are shared by sessions in this worker, like the VAD model
+        stt=_get_or_create(ctx.proc, "stt", _build_stt),
         llm=openai.LLM(
             model="gpt-4o", 
             parallel_tool_calls=False, 
             temperature=0.6
         ),
-        tts=openai.TTS.with_azure(
-            model=os.getenv("AZURE_OPENAI_DEPLOYMENT"),
-            voice="alloy",
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version=os.getenv("OPENAI_API_VERSION"),
-            azure_deployment=os.getenv("AZURE_OPENAI_DEPLOYMENT"),
-        ),
-        vad=silero.VAD.load(),
+        tts=_get_or_create(ctx.proc, "tts", _build_tts),
+        vad=ctx.proc.userdata["vad"],
         max_tool_steps=2,
         turn_detection=MultilingualModel() if TURN_DETECTOR_AVAILABLE else None,
     )
@@ -602,4 +965,4 @@ async def entrypoint(ctx: JobContext):
         )
 
 if __name__ == "__main__":
-    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint))
\ No newline at end of file
+    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint, prewarm_fnc=prewarm))
\ No newline at end of file